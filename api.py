@@ -1,51 +1,50 @@
 # api.py
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 import uvicorn
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from tools import (
-    retrieve,
+    load_resources,
+    embed_query_async,
+    search,
+    semantic_cache_get,
+    semantic_cache_put,
+    choose_title_async,
     looks_like_gibberish,
     is_inappropriate,
     get_summary_by_title,
+    ABSTAIN_TOKEN,
     GIBBERISH_DISTANCE_THRESH,
+    LLM_CACHE_STATS,
 )
 
 load_dotenv(override=True)
-client = OpenAI()
-
-ABSTAIN_TOKEN = "ABSTAIN"
-
-def choose_title(user_query: str, candidates, best_distance: float, threshold: float):
-    titles_list = ", ".join(b["title"] for b in candidates)
-    messages = [
-        {
-            "role": "system",
-            "content": (
-            "You are a strict title selector. Choose exactly one title from the provided list. "
-            "Reply EXACTLY with 'ABSTAIN' only if the request is not about books at all or is pure gibberish. "
-            "Do NOT abstain solely because the BestDistance is moderately high; prefer the closest title. "
-            "Never invent a title."
-        ),
-
-        },
-        {
-            "role": "user",
-            "content": (
-                f"Request: {user_query}\n"
-                f"Candidates: {titles_list}\n"
-                f"BestDistance: {best_distance}\n"
-                f"Reply with ONE exact title from Candidates, or '{ABSTAIN_TOKEN}'."
-            ),
-        },
-    ]
-    r = client.chat.completions.create(model="gpt-4o-mini", messages=messages, temperature=0)
-    return r.choices[0].message.content.strip()
-
-app = FastAPI()
+
+WORKERS = max(2, (os.cpu_count() or 2) // 2)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One AsyncOpenAI client (and its connection pool) shared by every request
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+    app.state.client = AsyncOpenAI(http_client=http_client)
+    # Load the embedder + index in each worker before it serves; split the cores between workers
+    await asyncio.to_thread(load_resources, max(1, (os.cpu_count() or 1) // WORKERS))
+    yield
+    await app.state.client.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS for Vite dev
 app.add_middleware(
@@ -57,7 +56,10 @@ app.add_middleware(
 )
 
 class ChatIn(BaseModel):
-    query: str
+    # Stripping and length checks run in pydantic-core; empty/oversized queries get a 422
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    query: str = Field(..., min_length=1, max_length=2000)
 
 class ChatOut(BaseModel):
     title: str
@@ -66,20 +68,12 @@ class ChatOut(BaseModel):
 
 @app.get("/health")
 def health():
-    return {"ok": True}
-
-@app.post("/chat", response_model=ChatOut)
-def chat(body: ChatIn):
-    q = (body.query or "").strip()
-    if not q:
-        raise HTTPException(status_code=400, detail="Empty question.")
-    if is_inappropriate(q):
-        raise HTTPException(status_code=400, detail="Please keep it polite and safe.")
-    if looks_like_gibberish(q):
-        raise HTTPException(status_code=400, detail="I couldn't understand that. Try a clearer request (e.g., 'dark fantasy about loyalty').")
+    return {"ok": True, "llm_cache": LLM_CACHE_STATS}
 
-    # Retrieve from Chroma
-    cands, best_dist = retrieve(q, k=6)
+async def _pick_title(q: str, q_emb, client: AsyncOpenAI):
+    """Retrieves candidates and asks the LLM for one; returns (title, reason), reason "" on fallback."""
+    # Retrieve from the FAISS index (local, blocking) off the event loop
+    cands, best_dist = await asyncio.to_thread(search, q_emb, 6)
     if not cands:
         raise HTTPException(status_code=400, detail="No candidates found.")
 
@@ -94,20 +88,55 @@ def chat(body: ChatIn):
         raise HTTPException(status_code=400, detail="No close matches. Add topics, mood, or genre.")
 
     # Ask LLM to pick exactly one title, with ABSTAIN fallback
-    title_or_abstain = choose_title(q, cands, best_dist, GIBBERISH_DISTANCE_THRESH)
+    title_or_abstain, reason = await choose_title_async(q, cands, best_dist, client)
 
     # If the model abstains but the query is not tiny, fall back to the top-1 candidate
     if title_or_abstain.upper() == ABSTAIN_TOKEN:
         if very_short:
             raise HTTPException(status_code=400, detail="No close matches. Add topics, mood, or genre.")
-        title = cands[0]["title"]
+        return cands[0]["title"], ""
+    return title_or_abstain, reason
+
+@app.post("/chat", response_model=ChatOut)
+async def chat(body: ChatIn, request: Request):
+    client = request.app.state.client
+    q = body.query
+    # Cheapest rejection first: too short to be a request, no need to scan or embed it
+    if len(q) < 3:
+        raise HTTPException(status_code=400, detail="I couldn't understand that. Try a clearer request (e.g., 'dark fantasy about loyalty').")
+
+    if is_inappropriate(q):
+        raise HTTPException(status_code=400, detail="Please keep it polite and safe.")
+    if looks_like_gibberish(q):
+        raise HTTPException(status_code=400, detail="I couldn't understand that. Try a clearer request (e.g., 'dark fantasy about loyalty').")
+
+    # Embedding runs in a worker thread so the event loop keeps serving other requests
+    q_emb = await embed_query_async(q)
+
+    # Near-identical earlier query: temperature=0 makes its (title, model reason) safe to reuse
+    cached = semantic_cache_get(q_emb)
+    if cached is not None:
+        title, reason = cached
     else:
-        title = title_or_abstain
+        title, reason = await _pick_title(q, q_emb, client)
+        semantic_cache_put(q_emb, (title, reason))
 
-    reason = f"Selected based on theme similarity to your request: \"{q}\"."
+    # The fallback reason quotes this request, so it is built here and never cached
+    if not reason:
+        reason = f"Selected based on theme similarity to your request: \"{q}\"."
     summary = get_summary_by_title(title)
     return ChatOut(title=title, reason=reason, summary=summary)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # Multiple workers need the import string. Importing api/tools here is cheap: the supervisor
+    # never runs the lifespan, so only the workers load torch, the embedder and the index.
+    uvicorn.run(
+        "api:app",
+        host="127.0.0.1",
+        port=8000,
+        workers=WORKERS,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",   # uvloop has no Windows build
+        http="httptools",
+        timeout_keep_alive=30,
+    )
@@ -1,44 +1,79 @@
-import json, os
 import os
+import shutil
+import time
 from dotenv import load_dotenv
-import chromadb
-from chromadb.config import Settings
-from openai import OpenAI
+import faiss
+import numpy as np
+import orjson
+from sentence_transformers import SentenceTransformer
 
 load_dotenv(override=True)  # ensures .env always wins
 
-client = OpenAI()
-
-CHROMA_DIR = "chroma_db"
+INDEX_DIR = "faiss_index"
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"   # must match tools.EMBED_MODEL
+EMBED_BATCH = 256    # texts per encode() batch
+ADD_BATCH = 1000     # vectors per index.add()
 
 def embed(texts):
-    resp = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=texts
-    )
-    return [d.embedding for d in resp.data]
+    model = SentenceTransformer(EMBED_MODEL)
+    embs = model.encode(texts, batch_size=EMBED_BATCH, normalize_embeddings=True)
+    return np.asarray(embs, dtype=np.float32)
 
-def main():
-    # init chroma (local persistent)
-    chroma_client = chromadb.PersistentClient(path=CHROMA_DIR, settings=Settings(allow_reset=True))
+def _read_current():
     try:
-        chroma_client.delete_collection("books")
-    except:
-        pass
-    coll = chroma_client.create_collection(name="books", metadata={"hnsw:space": "cosine"})
+        with open(os.path.join(INDEX_DIR, "CURRENT"), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
 
+def _set_current(build):
+    """Atomically points INDEX_DIR/CURRENT at build (a sibling file + os.replace, normal umask permissions)."""
+    tmp = os.path.join(INDEX_DIR, f".CURRENT.{os.getpid()}")
+    with open(tmp, "x", encoding="utf-8") as f:
+        f.write(build)
+    os.replace(tmp, os.path.join(INDEX_DIR, "CURRENT"))
+
+def main():
     # load data
-    with open("data/book_summaries.json", "r", encoding="utf-8") as f:
-        books = json.load(f)
+    with open("data/book_summaries.json", "rb") as f:
+        books = orjson.loads(f.read())
 
     # use the 'short' field (themes) as retrievable content
     texts = [b["short"] for b in books]
-    ids = [b["title"] for b in books]
-    metadatas = [{"title": b["title"], "full": b["full"]} for b in books]
+    meta = [{"title": b["title"]} for b in books]
 
+    # exact search; vectors are unit-normalized so inner product == cosine similarity
     embs = embed(texts)
-    coll.add(documents=texts, metadatas=metadatas, ids=ids, embeddings=embs)
-    print(f"Indexed {len(books)} books into Chroma at {CHROMA_DIR}")
+    index = faiss.IndexFlatIP(embs.shape[1])
+    for i in range(0, len(books), ADD_BATCH):
+        index.add(embs[i:i + ADD_BATCH])
+
+    # full summaries as one UTF-8 blob + offsets (row i spans offsets[i]:offsets[i+1]); tools.py mmaps it
+    blobs = [b["full"].encode("utf-8") for b in books]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+
+    # Each build gets its own directory and CURRENT is switched only once every file is written, so a
+    # process that starts mid-rebuild loads the whole old build or the whole new one, never a mix.
+    # Running processes keep mmapping the old build. row i of the index <-> meta[i] <-> offsets[i].
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    previous = _read_current()
+    build = f"build-{time.time_ns()}"
+    build_dir = os.path.join(INDEX_DIR, build)
+    os.makedirs(build_dir)
+    faiss.write_index(index, os.path.join(build_dir, "books.faiss"))
+    with open(os.path.join(build_dir, "books_meta.json"), "wb") as f:
+        f.write(orjson.dumps(meta))
+    with open(os.path.join(build_dir, "summaries.bin"), "wb") as f:
+        f.write(b"".join(blobs))
+    np.save(os.path.join(build_dir, "summaries_offsets.npy"), offsets)
+    _set_current(build)
+
+    # Keep the previous build too: a process may have read the old CURRENT and still be loading it
+    for name in os.listdir(INDEX_DIR):
+        if name.startswith("build-") and name not in (build, previous):
+            shutil.rmtree(os.path.join(INDEX_DIR, name), ignore_errors=True)
+    print(f"Indexed {len(books)} books into FAISS at {build_dir}")
 
 if __name__ == "__main__":
     main()
@@ -1,89 +1,308 @@
 # tools.py
-import json, re
+import asyncio, functools, hashlib, json, mmap, re, threading, time
+from collections import OrderedDict
+from types import SimpleNamespace
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-import chromadb
-from chromadb.config import Settings
-from openai import OpenAI
+import faiss
+from openai import AsyncOpenAI, OpenAI
 from pathlib import Path
 
 
 load_dotenv(override=True)
 
 # --- Core RAG constants ---
-EMBED_MODEL = "text-embedding-3-small"
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"   # local, 384-dim; must match rag_init.py
 GIBBERISH_DISTANCE_THRESH = 0.75
+SEM_CACHE_SIM_THRESH = 0.92   # cosine similarity above which a prior answer is reused
+SEM_CACHE_MAX_ENTRIES = 1024
+LLM_CACHE_TTL_S = 3600.0
+LLM_CACHE_MAX_ENTRIES = 4096
 
-# --- OpenAI + Chroma singletons ---
-_client = OpenAI()
-_chroma = chromadb.PersistentClient(path="chroma_db", settings=Settings(allow_reset=False))
+# --- OpenAI + embedder + FAISS singletons ---
+# Nothing heavy happens at import: uvicorn's supervisor imports this module (via api.py) but never
+# serves requests, so the client, torch/the embedder and the index are built on first use per process.
 
-def _get_or_create_collection(name: str = "books"):
+@functools.cache
+def get_client() -> OpenAI:
+    """The process-wide sync OpenAI client on one pooled HTTP/2 transport, so chat calls reuse the connection."""
+    http = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=32, keepalive_expiry=30.0),
+        timeout=30.0,
+    )
+    return OpenAI(http_client=http)
+
+INDEX_DIR = (Path(__file__).parent / "faiss_index").resolve()
+
+def _current_build():
+    """The complete index build named by INDEX_DIR/CURRENT (rag_init.py switches it only after writing a build)."""
+    try:
+        return INDEX_DIR / (INDEX_DIR / "CURRENT").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        # Not built yet: run rag_init.py
+        return None
+
+def _load_index(build):
+    """Loads the flat inner-product index and its row-aligned book metadata written by rag_init.py."""
+    if build is None:
+        return None, []
     try:
-        return _chroma.get_collection(name)
-    except Exception:
-        # cosine matches the index you created in rag_init.py
-        return _chroma.create_collection(name=name, metadata={"hnsw:space": "cosine"})
+        index = faiss.read_index(str(build / "books.faiss"))
+        with open(build / "books_meta.json", "rb") as f:
+            meta = orjson.loads(f.read())
+        return index, meta
+    except Exception as e:
+        print(f"[tools] WARNING: couldn't load the index from {build}: {e}")
+        return None, []
+
+def _load_summaries(build):
+    """Maps the concatenated UTF-8 summaries and their offsets; the OS shares these pages across workers."""
+    if build is None:
+        return None, None
+    try:
+        with open(build / "summaries.bin", "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = np.load(build / "summaries_offsets.npy", mmap_mode="r")
+        return buf, offsets
+    except Exception as e:
+        print(f"[tools] WARNING: couldn't map the summaries from {build}: {e}")
+        return None, None
+
+_res = None
+_res_lock = threading.Lock()
+
+def load_resources(num_threads: int | None = None):
+    """Loads the embedder and the current index build once per process; later calls return the same objects.
+
+    num_threads caps torch/FAISS intra-op threads; with several workers on one machine pass
+    cpu_count // workers so they don't oversubscribe the cores. Only the first call's value applies.
+    """
+    global _res
+    if _res is not None:
+        return _res
+    with _res_lock:
+        if _res is None:
+            import torch   # heavy: imported only by processes that actually embed
+            from sentence_transformers import SentenceTransformer
+            if num_threads:
+                torch.set_num_threads(num_threads)
+                faiss.omp_set_num_threads(num_threads)
+            # Index, titles and summaries all come from the same build
+            build = _current_build()
+            index, meta = _load_index(build)
+            summaries, offsets = _load_summaries(build)
+            _res = SimpleNamespace(
+                embedder=SentenceTransformer(EMBED_MODEL),
+                index=index,
+                meta=meta,
+                summaries=summaries,
+                summary_offsets=offsets,
+                title_to_row={m["title"]: i for i, m in enumerate(meta)},
+            )
+    return _res
 
 # --- Embedding + retrieve ---
 def embed_query(text: str):
-    r = _client.embeddings.create(model=EMBED_MODEL, input=[text])
-    return r.data[0].embedding
+    return load_resources().embedder.encode([text], normalize_embeddings=True)[0].tolist()
 
-def retrieve(query: str, k: int = 6):
-    coll = _get_or_create_collection("books")
-    q_emb = embed_query(query)
-    res = coll.query(
-        query_embeddings=[q_emb],
-        n_results=k,
-        include=["documents", "metadatas", "distances"],
-    )
-    if not res["ids"] or not res["ids"][0]:
+async def embed_query_async(text: str):
+    # Local model inference; run it in a worker thread to keep the event loop free
+    return await asyncio.to_thread(embed_query, text)
+
+def search(q_emb, k: int = 6):
+    res = load_resources()
+    if res.index is None or not res.index.ntotal or k < 1:
         return [], 1.0
+    # Rows and queries are unit-normalized, so inner product == cosine similarity
+    q = np.asarray([q_emb], dtype=np.float32)
+    sims, rows = res.index.search(q, min(k, res.index.ntotal))
 
-    ids = res["ids"][0]
-    docs = res["documents"][0]
-    metas = res["metadatas"][0]
-    cands = [{"title": ids[i], "short": docs[i], "full": metas[i]["full"]} for i in range(len(ids))]
-    best_dist = res["distances"][0][0] if res.get("distances") and res["distances"][0] else 1.0
+    cands = [{"title": res.meta[row]["title"]} for row in rows[0].tolist()]
+    # Report cosine distance, as the Chroma index did, so GIBBERISH_DISTANCE_THRESH keeps its meaning.
+    # ntotal > 0 and k >= 1 here, so there is always a top hit.
+    best_dist = 1.0 - float(sims[0][0])
     return cands, best_dist
 
+def retrieve(query: str, k: int = 6):
+    return search(embed_query(query), k=k)
+
+# --- Semantic cache (query embedding -> prior answer) ---
+# Entries are stored unit-normalized so cosine similarity is a plain dot product. Rows live in one
+# preallocated matrix; slots 0..n-1 are always the filled ones, and eviction overwrites the LRU slot.
+_SEM_MATRIX = None                                    # (SEM_CACHE_MAX_ENTRIES, dim) float32, allocated on first put
+_SEM_VALUES: list = [None] * SEM_CACHE_MAX_ENTRIES
+_SEM_SLOT_KEYS: list = [None] * SEM_CACHE_MAX_ENTRIES
+_SEM_SLOTS: "OrderedDict[bytes, int]" = OrderedDict()   # key -> slot, least recently used first
+
+def _unit(q_emb) -> np.ndarray:
+    v = np.asarray(q_emb, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+def semantic_cache_get(q_emb):
+    """Returns the value cached for the most similar prior query, or None if nothing is close enough."""
+    if not _SEM_SLOTS:
+        return None
+    sims = _SEM_MATRIX[:len(_SEM_SLOTS)] @ _unit(q_emb)
+    best = int(np.argmax(sims))
+    if sims[best] < SEM_CACHE_SIM_THRESH:
+        return None
+    _SEM_SLOTS.move_to_end(_SEM_SLOT_KEYS[best])
+    return _SEM_VALUES[best]
+
+def semantic_cache_put(q_emb, value) -> None:
+    """Caches value under q_emb, overwriting the least recently used slot when full."""
+    global _SEM_MATRIX
+    q = _unit(q_emb)
+    key = q.tobytes()
+    if key in _SEM_SLOTS:
+        slot = _SEM_SLOTS[key]
+    elif len(_SEM_SLOTS) < SEM_CACHE_MAX_ENTRIES:
+        slot = len(_SEM_SLOTS)
+    else:
+        _, slot = _SEM_SLOTS.popitem(last=False)
+    if _SEM_MATRIX is None:
+        _SEM_MATRIX = np.zeros((SEM_CACHE_MAX_ENTRIES, q.shape[0]), dtype=np.float32)
+    _SEM_MATRIX[slot] = q
+    _SEM_VALUES[slot] = value
+    _SEM_SLOT_KEYS[slot] = key
+    _SEM_SLOTS[key] = slot
+    _SEM_SLOTS.move_to_end(key)
+
+# --- Exact-match LLM cache (temperature=0 calls only) ---
+_LLM_CACHE: dict[str, tuple[float, str]] = {}   # key -> (expires_at, message content)
+LLM_CACHE_STATS = {"hits": 0, "misses": 0}
+
+def llm_cache_key(**params) -> str:
+    """Stable key for a chat.completions request (model, messages, temperature, ...)."""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def llm_cache_get(key: str):
+    """Returns the cached message content for key, or None if missing or expired."""
+    entry = _LLM_CACHE.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        _LLM_CACHE.pop(key, None)
+        LLM_CACHE_STATS["misses"] += 1
+        return None
+    LLM_CACHE_STATS["hits"] += 1
+    return entry[1]
+
+def llm_cache_put(key: str, content: str) -> None:
+    if key not in _LLM_CACHE and len(_LLM_CACHE) >= LLM_CACHE_MAX_ENTRIES:
+        _LLM_CACHE.pop(next(iter(_LLM_CACHE)))  # drop the oldest insert
+    _LLM_CACHE[key] = (time.monotonic() + LLM_CACHE_TTL_S, content)
+
+# --- Title selection (shared by api.py and chat_cli.py) ---
+ABSTAIN_TOKEN = "ABSTAIN"
+TITLE_MODEL = "gpt-4o-mini"
+
+# Built once at import so choose_title() does not rebuild the constant system message on every call
+_TITLE_SYSTEM_MSG = {
+    "role": "system",
+    "content": (
+        "You are a strict title selector. Choose exactly one title from the provided list. "
+        f"Set title to '{ABSTAIN_TOKEN}' only if the request is not about books at all or is pure gibberish. "
+        "Do NOT abstain solely because the BestDistance is moderately high; prefer the closest title. "
+        "Never invent a title. "
+        "Answer in JSON as {\"title\": \"...\", \"reason\": \"...\"}, where reason is one short "
+        "sentence explaining why the book fits the request."
+    ),
+}
+
+def _title_request(user_query: str, candidates, best_distance: float) -> dict:
+    titles_list = ", ".join(b["title"] for b in candidates)
+    messages = [
+        _TITLE_SYSTEM_MSG,
+        {
+            "role": "user",
+            "content": (
+                f"Request: {user_query}\n"
+                f"Candidates: {titles_list}\n"
+                f"BestDistance: {best_distance}\n"
+                f"Set title to ONE exact title from Candidates, or '{ABSTAIN_TOKEN}'."
+            ),
+        },
+    ]
+    return dict(model=TITLE_MODEL, messages=messages, temperature=0, response_format={"type": "json_object"})
+
+def _parse_title_reply(content):
+    try:
+        data = json.loads(content)
+    except (TypeError, json.JSONDecodeError):
+        return ABSTAIN_TOKEN, ""
+    return str(data.get("title") or ABSTAIN_TOKEN).strip(), str(data.get("reason") or "").strip()
+
+def _title_lookup(user_query: str, candidates, best_distance: float):
+    """Builds the selection request and checks the exact-match cache; returns (params, key, content or None)."""
+    params = _title_request(user_query, candidates, best_distance)
+    # temperature=0: an identical request gets the same answer, so serve repeats from cache
+    key = llm_cache_key(**params)
+    return params, key, llm_cache_get(key)
+
+def _title_store(key: str, response):
+    content = response.choices[0].message.content
+    if content:
+        llm_cache_put(key, content)
+    return content
+
+def choose_title(user_query: str, candidates, best_distance: float, client: OpenAI):
+    """Returns (title, reason) for one candidate, or (ABSTAIN_TOKEN, "") if the model abstains."""
+    params, key, content = _title_lookup(user_query, candidates, best_distance)
+    if content is None:
+        content = _title_store(key, client.chat.completions.create(**params))
+    return _parse_title_reply(content)
+
+async def choose_title_async(user_query: str, candidates, best_distance: float, client: AsyncOpenAI):
+    """Async variant of choose_title(); shares its prompt and cache."""
+    params, key, content = _title_lookup(user_query, candidates, best_distance)
+    if content is None:
+        content = _title_store(key, await client.chat.completions.create(**params))
+    return _parse_title_reply(content)
+
 # --- Gibberish/bad-words helpers ---
+_RE_NONLETTERS = re.compile(r'[^A-Za-z\u00C0-\u024F]+')
+_RE_CONSONANTS = re.compile(r'[bcdfghjklmnpqrstvwxz]{6,}', re.IGNORECASE)
+_RE_REPEAT = re.compile(r'(.)\1{4,}')
+_RE_WORDY = re.compile(r'[A-Za-z\u00C0-\u024F]{2,}')
+# Deletes exactly the letters matched above (A-Z, a-z, U+00C0-U+024F); used to count them in C
+_LETTERS_DELETE = dict.fromkeys([*range(ord("A"), ord("Z") + 1), *range(ord("a"), ord("z") + 1), *range(0xC0, 0x250)])
+
+@functools.lru_cache(maxsize=8192)
 def looks_like_gibberish(text: str) -> bool:
     s = (text or "").strip()
     if len(s) < 3:
         return True
-    if re.fullmatch(r'[^A-Za-z\u00C0-\u024F]+', s):  # only non-letters
+    if _RE_NONLETTERS.fullmatch(s):  # only non-letters
         return True
-    letters = re.findall(r'[A-Za-z\u00C0-\u024F]', s)
-    if len(letters) / max(1, len(s)) < 0.5:          # too many non-letters
+    letters = len(s) - len(s.translate(_LETTERS_DELETE))
+    if letters / max(1, len(s)) < 0.5:          # too many non-letters
         return True
-    if re.search(r'(?i)[bcdfghjklmnpqrstvwxz]{6,}', s):  # absurd consonant cluster
+    if _RE_CONSONANTS.search(s):  # absurd consonant cluster
         return True
-    if re.search(r'(.)\1{4,}', s):  # xxxxx
+    if _RE_REPEAT.search(s):  # xxxxx
         return True
-    if not re.findall(r'[A-Za-z\u00C0-\u024F]{2,}', s):  # no word-like tokens
+    if not _RE_WORDY.search(s):  # no word-like tokens
         return True
     return False
 
 BAD_WORDS = {"idiot", "stupid", "fuck", "shit"}  # expand as needed
+# One alternation scans the text once; substring semantics as before, so "idiots" still matches
+_RE_BAD_WORDS = re.compile("|".join(map(re.escape, sorted(BAD_WORDS))), re.IGNORECASE)
 
+@functools.lru_cache(maxsize=8192)
 def is_inappropriate(text: str) -> bool:
-    lower = (text or "").lower()
-    return any(w in lower for w in BAD_WORDS)
-
-
-DATA_FILE = (Path(__file__).parent / "data" / "book_summaries.json").resolve()
+    return _RE_BAD_WORDS.search(text or "") is not None
 
-try:
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        _BOOKS = {b["title"]: b for b in json.load(f)}
-except Exception as e:
-    _BOOKS = {}
-    # Optional: print(f"[tools] WARNING: couldn't load {DATA_FILE}: {e}")
 
 def get_summary_by_title(title: str) -> str:
     """Returns the full summary for an exact title."""
-    book = _BOOKS.get(title)
-    if not book:
+    res = load_resources()
+    row = res.title_to_row.get(title)
+    if row is None or res.summaries is None:
         return f"I couldn't find a summary for \"{title}\"."
-    return book["full"]
\ No newline at end of file
+    start, end = int(res.summary_offsets[row]), int(res.summary_offsets[row + 1])
+    return res.summaries[start:end].decode("utf-8")